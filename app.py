@@ -1,27 +1,62 @@
-# install:  pip install fastapi uvicorn pycrdt requests
+# install:  pip install fastapi uvicorn pycrdt httpx
 # run:      uvicorn app:app --reload --port 8000
 
+import asyncio
 import base64
+import hashlib
+import json
+import queue
 import sqlite3
 import threading
 import time
-from typing import List, Tuple, Optional
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from typing import Iterator, List, Tuple, Optional
 
-from fastapi import Body, FastAPI, HTTPException
+from fastapi import Body, FastAPI, Header, HTTPException, Request, Response
 from pydantic import BaseModel
 
 # --- CRDT runtime (pycrdt) ---
 # Usage ref: https://y-crdt.github.io/pycrdt/usage/
-from pycrdt import Doc as YDoc, Map as YMap, Array as YArr
-import requests
+from pycrdt import Doc as YDoc, Map as YMap, Array as YArr, merge_updates
+import httpx
 
 DOC_ID = "demo-1"
 DB_PATH = "file:node-py.db"
 PEER_BASE = "http://localhost:3030"
+READER_POOL_SIZE = 4
+UPDATE_COALESCE_WINDOW = 0.005  # seconds; /update 쓰기를 모아 한 번에 commit
+LOCAL_FLUSH_DELAY = 0.05  # seconds; /add-count diff를 모아 한 update로 기록
+DIFF_CACHE_SIZE = 64  # /diff 결과 LRU (sv -> diff) 항목 수
+COMPACT_MIN_UPDATES = 64  # /do-sync 컴팩션 기준: 누적 update 수
+COMPACT_MIN_BYTES = 1 << 20  # /do-sync 컴팩션 기준: 누적 update 크기
+PEER_TIMEOUT = httpx.Timeout(5.0, connect=1.0)  # seconds
+OCTET_STREAM = "application/octet-stream"  # peer 간 raw update/sv 전송용
+EMPTY_UPDATE = b"\x00\x00"  # 내용 없는 update의 인코딩
+
+
+# ---------------- Peer HTTP client (keep-alive pool) ---------------
+# lifespan에서 열고 닫음 (app.state.peer) -> 앱이 다시 시작되면 새 client 사용
+def _open_peer() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=PEER_BASE,
+        timeout=PEER_TIMEOUT,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=4),
+    )
 
 
 # ---------------- SQLite schema (updates + snapshots) -------------
 db = sqlite3.connect(DB_PATH, check_same_thread=False)
+# 컴팩션 DELETE로 생긴 빈 페이지를 회수할 수 있도록 (테이블 생성 전에 설정해야 적용됨)
+db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+# WAL: 읽기가 쓰기에 막히지 않고, commit당 fsync 횟수도 줄어듦
+db.execute("PRAGMA journal_mode=WAL")
+db.execute("PRAGMA synchronous=NORMAL")
+db.execute("PRAGMA temp_store=MEMORY")
+db.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+db.execute("PRAGMA cache_size=-65536")  # 64 MiB
+db.execute("PRAGMA wal_autocheckpoint=1000")
 db.execute("""
 CREATE TABLE IF NOT EXISTS updates (
 doc_id          TEXT    NOT NULL,
@@ -40,94 +75,437 @@ last_seq   INTEGER NOT NULL,
 updated_at INTEGER NOT NULL
 );
 """)
+
+# updates는 항상 doc_id=? AND seq 범위로 조회/삭제 -> (doc_id, seq) 인덱스
+db.execute("CREATE INDEX IF NOT EXISTS ix_updates_doc_seq ON updates(doc_id, seq)")
 db.commit()
-db_lock = threading.Lock()
+if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+    # auto_vacuum 없이 만들어진 기존 DB 파일 -> 1회 VACUUM으로 INCREMENTAL 전환
+    db.execute("VACUUM")
+db_lock = threading.Lock()  # writer(db) 전용
+
+
+# 읽기 전용 커넥션 풀: WAL에서는 writer와 동시에 읽을 수 있으므로 db_lock 불필요
+def _open_reader() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA query_only=1")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+
+db_readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+for _ in range(READER_POOL_SIZE):
+    db_readers.put(_open_reader())
+
+
+@contextmanager
+def db_reader() -> Iterator[sqlite3.Connection]:
+    conn = db_readers.get()
+    try:
+        yield conn
+    finally:
+        db_readers.put(conn)
+
+
+# ---------------- SQL (module constants) ---------------------------
+# 같은 SQL 문자열을 재사용해야 sqlite3의 statement cache에서 prepare 결과가 재사용됨
+_SQL_INSERT_UPDATE = (
+    "INSERT INTO updates (doc_id, update_data, origin, received_at) VALUES (?, ?, ?, ?)"
+)
+_SQL_LAST_ROWID = "SELECT last_insert_rowid()"
+_SQL_UPSERT_SNAPSHOT = """
+INSERT INTO snapshots (doc_id, snapshot_data, last_seq, updated_at)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(doc_id) DO UPDATE SET
+  snapshot_data=excluded.snapshot_data,
+  last_seq=excluded.last_seq,
+  updated_at=excluded.updated_at
+"""
+_SQL_SNAPSHOT_SEQ = "SELECT last_seq FROM snapshots WHERE doc_id=?"
+_SQL_SNAPSHOT_DATA = "SELECT snapshot_data FROM snapshots WHERE doc_id=?"
+_SQL_SNAPSHOT_META = (
+    "SELECT last_seq, length(snapshot_data) FROM snapshots WHERE doc_id=?"
+)
+_SQL_LOAD_SINCE = (
+    "SELECT seq, update_data FROM updates WHERE doc_id=? AND seq>? ORDER BY seq ASC"
+)
+_SQL_DELETE_UPTO = "DELETE FROM updates WHERE doc_id=? AND seq<=?"
+_SQL_DELETE_UPDATES = "DELETE FROM updates WHERE doc_id=?"
+_SQL_DELETE_SNAPSHOT = "DELETE FROM snapshots WHERE doc_id=?"
+_SQL_PENDING_STATS = """
+SELECT COUNT(*), COALESCE(SUM(length(update_data)),0) FROM updates
+WHERE doc_id=? AND seq > COALESCE((SELECT last_seq FROM snapshots WHERE doc_id=?),0)
+"""
+_SQL_MAX_SEQ = "SELECT COALESCE(MAX(seq),0) FROM updates WHERE doc_id=?"
+# execute()는 1 step만 실행해 1 page만 회수되므로 executescript()로 실행
+_SQL_INCREMENTAL_VACUUM = "PRAGMA incremental_vacuum(64);"
 
 
 # ---------------- DB helpers --------------------------------------
 def db_insert_update(update_bytes: bytes, origin: str = "") -> int:
     global db, doc_lock
     with db_lock:
-        cur = db.cursor()
-        cur.execute(
-            "INSERT INTO updates (doc_id, update_data, origin, received_at) VALUES (?, ?, ?, ?)",
+        cur = db.execute(
+            _SQL_INSERT_UPDATE,
             # (DOC_ID, sqlite3.Binary(update_bytes), origin, int(time.time() * 1000)),
             (DOC_ID, update_bytes, origin, int(time.time() * 1000)),
         )
         db.commit()
-        return int(cur.lastrowid or -1)
+        seq = int(cur.lastrowid or -1)
+    doc_cache.apply([(seq, update_bytes)])
+    return seq
 
 
-def db_get_snapshot_row() -> Tuple[Optional[bytes], int]:
+def db_insert_updates_bulk(rows: List[Tuple[bytes, str]]) -> List[int]:
+    """Insert (update_bytes, origin) rows in one transaction; returns their seqs."""
     global db, doc_lock
+    if not rows:
+        return []
+    now = int(time.time() * 1000)
     with db_lock:
-        cur = db.cursor()
-        cur.execute(
-            "SELECT snapshot_data, last_seq FROM snapshots WHERE doc_id=?", (DOC_ID,)
-        )
-        row = cur.fetchone()
-        if not row:
-            return None, 0
-        return row[0], int(row[1])
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                _SQL_INSERT_UPDATE,
+                [(DOC_ID, update_bytes, origin, now) for update_bytes, origin in rows],
+            )
+            last = int(db.execute(_SQL_LAST_ROWID).fetchone()[0])
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+    # AUTOINCREMENT + 단일 writer 트랜잭션이므로 seq는 연속
+    seqs = list(range(last - len(rows) + 1, last + 1))
+    doc_cache.apply(
+        [(seq, update_bytes) for seq, (update_bytes, _o) in zip(seqs, rows)]
+    )
+    return seqs
 
 
 def db_upsert_snapshot(snapshot_bytes: bytes, last_seq: int) -> None:
     global db, doc_lock
     with db_lock:
         db.execute(
-            """
-            INSERT INTO snapshots (doc_id, snapshot_data, last_seq, updated_at)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(doc_id) DO UPDATE SET
-              snapshot_data=excluded.snapshot_data,
-              last_seq=excluded.last_seq,
-              updated_at=excluded.updated_at
-            """,
+            _SQL_UPSERT_SNAPSHOT,
             # (DOC_ID, sqlite3.Binary(snapshot_bytes), last_seq, int(time.time() * 1000)),
             (DOC_ID, snapshot_bytes, last_seq, int(time.time() * 1000)),
         )
         db.commit()
 
 
-def db_load_updates_since(seq_exclusive: int) -> List[Tuple[int, bytes]]:
+@contextmanager
+def db_iter_updates_since(
+    seq_exclusive: int,
+) -> Iterator[Tuple[Optional[bytes], int, Iterator[Tuple[int, bytes]]]]:
+    """
+    seq_exclusive 이후 변경분을 한 read 트랜잭션으로 읽음 (중간에 컴팩션이 끼어도 일관됨).
+    snapshot이 seq_exclusive 이후로 갱신됐으면 snapshot bytes도 함께 반환.
+    -> with ... as (snapshot_bytes | None, snapshot_last_seq, (seq, update_bytes) 스트림)
+    update row는 fetchall() 없이 커서에서 바로 읽으므로 with 블록 안에서만 사용.
+    """
+    with db_reader() as conn:
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute(_SQL_SNAPSHOT_SEQ, (DOC_ID,)).fetchone()
+            snap_seq = row[0] if row else 0
+            snap_bytes = None
+            if row and snap_seq > seq_exclusive:
+                snap_bytes = conn.execute(_SQL_SNAPSHOT_DATA, (DOC_ID,)).fetchone()[0]
+            yield snap_bytes, snap_seq, conn.execute(
+                _SQL_LOAD_SINCE, (DOC_ID, max(seq_exclusive, snap_seq))
+            )
+        finally:
+            conn.rollback()
+
+
+def db_finalize_compaction(snapshot_bytes: bytes, last_seq: int) -> int:
+    """Upsert snapshot and delete the updates it covers in one transaction."""
     global db, doc_lock
     with db_lock:
-        cur = db.cursor()
-        cur.execute(
-            "SELECT seq, update_data FROM updates WHERE doc_id=? AND seq>? ORDER BY seq ASC",
-            (DOC_ID, seq_exclusive),
-        )
-        return [(int(s), u) for (s, u) in cur.fetchall()]
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                _SQL_UPSERT_SNAPSHOT,
+                (DOC_ID, snapshot_bytes, last_seq, int(time.time() * 1000)),
+            )
+            deleted = int(
+                db.execute(_SQL_DELETE_UPTO, (DOC_ID, last_seq)).rowcount or 0
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        # 지운 update들이 남긴 빈 페이지 회수 (파일/page cache 크기 유지)
+        db.executescript(_SQL_INCREMENTAL_VACUUM)
+        return deleted
 
 
-def db_delete_updates_upto(seq_inclusive: int) -> int:
+def db_init() -> None:
     global db, doc_lock
     with db_lock:
-        cur = db.cursor()
-        cur.execute(
-            "DELETE FROM updates WHERE doc_id=? AND seq<=?", (DOC_ID, seq_inclusive)
-        )
+        db.execute(_SQL_DELETE_UPDATES, (DOC_ID,))
+        db.execute(_SQL_DELETE_SNAPSHOT, (DOC_ID,))
         db.commit()
-        return int(cur.rowcount or 0)
 
 
-def db_init() -> None:
-    global db, doc_lock
-    with db_lock:
-        cur = db.cursor()
-        cur.execute("DELETE FROM updates WHERE doc_id=?", (DOC_ID,))
-        cur.execute("DELETE FROM snapshots WHERE doc_id=?", (DOC_ID,))
-    db.commit()
+def db_get_snapshot_meta() -> Tuple[int, int]:
+    """(last_seq, snapshot byte size) without reading the BLOB itself."""
+    with db_reader() as conn:
+        row = conn.execute(_SQL_SNAPSHOT_META, (DOC_ID,)).fetchone()
+        if not row:
+            return 0, 0
+        return int(row[0]), int(row[1])
+
+
+def db_get_pending_stats() -> Tuple[int, int]:
+    """(count, total bytes) of updates not yet folded into the snapshot."""
+    with db_reader() as conn:
+        count, size = conn.execute(_SQL_PENDING_STATS, (DOC_ID, DOC_ID)).fetchone()
+        return int(count), int(size)
 
 
 def db_get_max_seq() -> int:
-    global db, doc_lock
-    with db_lock:
-        cur = db.cursor()
-        cur.execute(
-            "SELECT COALESCE(MAX(seq),0) FROM updates WHERE doc_id=?", (DOC_ID,)
-        )
-        return int(cur.fetchone()[0])
+    with db_reader() as conn:
+        return int(conn.execute(_SQL_MAX_SEQ, (DOC_ID,)).fetchone()[0])
+
+
+# ---------------- Update write coalescer ---------------------------
+# 짧은 시간(UPDATE_COALESCE_WINDOW) 안에 들어온 쓰기를 모아 db_insert_updates_bulk 한 번으로 처리
+update_queue: "queue.Queue[Tuple[List[Tuple[bytes, str]], Future]]" = queue.Queue()
+
+
+def _update_coalescer() -> None:
+    while True:
+        batch = [update_queue.get()]
+        deadline = time.monotonic() + UPDATE_COALESCE_WINDOW
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(update_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # 이 스레드가 죽으면 이후 모든 쓰기가 멈추므로 BaseException까지 잡고,
+        # batch의 future는 예외가 나도 빠짐없이 완료시킴
+        try:
+            seqs = db_insert_updates_bulk([row for rows, _fut in batch for row in rows])
+        except BaseException:
+            # 한 요청의 row 때문에 같은 batch의 다른 요청까지 실패하지 않도록 요청별로 재시도
+            # (db_insert_updates_bulk는 commit 전에만 실패하므로 중복 기록 없음)
+            for rows, fut in batch:
+                try:
+                    fut.set_result(db_insert_updates_bulk(rows))
+                except BaseException as e:
+                    fut.set_exception(e)
+            continue
+
+        offset = 0
+        for rows, fut in batch:
+            fut.set_result(seqs[offset : offset + len(rows)])
+            offset += len(rows)
+
+
+threading.Thread(target=_update_coalescer, name="update-coalescer", daemon=True).start()
+
+
+def enqueue_updates(rows: List[Tuple[bytes, str]]) -> "Future[List[int]]":
+    """Hand rows to the coalescer; the future resolves to their seqs once committed."""
+    fut: Future = Future()
+    update_queue.put((rows, fut))
+    return fut
+
+
+# ---------------- Durable doc cache (in-memory) --------------------
+def _merge_updates(updates: List[bytes]) -> bytes:
+    # 여러 update를 하나로 합쳐 apply_update(FFI) 호출을 1회로 줄임
+    return updates[0] if len(updates) == 1 else merge_updates(*updates)
+
+
+class _DocCache:
+    """
+    DB(snapshot + updates)를 재생한 'durable' 문서를 메모리에 유지.
+    last_seq까지의 update가 모두 반영된 상태이며, doc은 lock을 잡고 사용.
+    diffs는 sv -> get_update(sv) LRU로, 문서가 바뀔 때마다 비움.
+    version은 문서가 바뀔 때마다 증가 (외부 파생 캐시의 무효화 기준).
+    sv는 get_state() 결과 캐시로, 문서가 바뀌면 None (다음 조회 때 1회 계산).
+    """
+
+    def __init__(self) -> None:
+        self.doc: Optional[YDoc] = None
+        self.last_seq = 0
+        self.lock = threading.RLock()
+        self.diffs: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self.version = 0
+        self.sv: Optional[bytes] = None
+
+    def touch(self) -> None:
+        """문서가 바뀌었음을 표시 (파생 캐시 무효화)."""
+        self.version += 1
+        self.diffs.clear()
+        self.sv = None
+
+    def reset(self, doc: Optional[YDoc] = None, last_seq: int = 0) -> None:
+        with self.lock:
+            self.doc = doc
+            self.last_seq = last_seq
+            self.touch()
+
+    def catch_up(self) -> YDoc:
+        """DB에서 last_seq 이후 변경분을 가져와 반영 (최초 호출 시 전체 재생)."""
+        with self.lock:
+            if self.doc is None:
+                self.doc = YDoc(allow_multithreading=True)
+                self.last_seq = -1
+            with db_iter_updates_since(self.last_seq) as (snap_bytes, snap_seq, rows):
+                pending = []
+                last_seq = max(self.last_seq, snap_seq)
+                for seq, u in rows:
+                    pending.append(u)
+                    last_seq = seq
+            if snap_bytes:
+                # snapshot은 merge 없이 그대로 적용: merge_updates가 snapshot 크기만큼
+                # 새 버퍼를 만들고 다시 decode하는 비용을 피함 (이미 반영된 부분은 무시됨)
+                self.doc.apply_update(snap_bytes)
+            if pending:
+                self.doc.apply_update(_merge_updates(pending))
+            if snap_bytes or pending:
+                self.touch()
+            self.last_seq = last_seq
+            return self.doc
+
+    def apply(self, rows: List[Tuple[int, bytes]]) -> None:
+        """DB에 commit된 연속 seq의 (seq, update)들을 캐시 문서에도 한 번에 반영."""
+        with self.lock:
+            if self.doc is None:
+                return
+            rows = [(seq, u) for seq, u in rows if seq > self.last_seq]
+            if not rows:
+                return
+            try:
+                if rows[0][0] != self.last_seq + 1:
+                    # 다른 writer의 update가 아직 반영 전 -> DB 기준으로 따라잡기
+                    self.catch_up()
+                    return
+                self.doc.apply_update(_merge_updates([u for _s, u in rows]))
+                self.last_seq = rows[-1][0]
+                self.touch()
+            except BaseException:
+                # 이미 commit된 쓰기이므로 호출자에게 실패로 전파하지 않음.
+                # 캐시만 버리고 다음 조회 때 DB에서 다시 재생 (pycrdt panic은 BaseException)
+                self.reset()
+
+    def apply_if_changed(self, updates: List[bytes]) -> List[bool]:
+        """
+        update들을 캐시 문서에 먼저 적용하고, 실제로 문서를 바꾼 것만 True.
+        이미 가진 내용만 담은 update(예: 상대가 매번 다시 보내는 delete set)는
+        byte 비교로는 걸러지지 않으므로 transaction 이벤트 발생 여부로 판단.
+        True인 update는 DB commit 전에 캐시에 반영된 상태 -> 기록에 실패하면 reset().
+        """
+        with self.lock:
+            doc = self.catch_up()
+            changed = []
+            for update_bytes in updates:
+                events: List[object] = []
+                sub = doc.observe(events.append)
+                try:
+                    doc.apply_update(update_bytes)
+                finally:
+                    doc.unobserve(sub)
+                changed.append(bool(events))
+            if any(changed):
+                self.touch()
+            return changed
+
+    def state_vector(self) -> bytes:
+        """get_state(); 문서가 바뀌기 전까지는 캐시된 값을 lock 없이 반환."""
+        sv = self.sv
+        if sv is not None:
+            return sv
+        with self.lock:
+            if self.sv is None:
+                self.sv = self.catch_up().get_state()
+            return self.sv
+
+    def diff_since(self, sv: bytes) -> bytes:
+        """
+        get_update(sv); 같은 sv로 반복 polling하는 peer에겐 캐시된 diff를 반환.
+        상대가 모르는 변경이 없으면 (get_update가 EMPTY_UPDATE를 돌려줄 때) b"".
+        """
+        with self.lock:
+            doc = self.catch_up()
+            diff = self.diffs.get(sv)
+            if diff is not None:
+                self.diffs.move_to_end(sv)
+                return diff
+            diff = doc.get_update(sv)
+            if diff == EMPTY_UPDATE:
+                diff = b""
+            self.diffs[sv] = diff
+            if len(self.diffs) > DIFF_CACHE_SIZE:
+                self.diffs.popitem(last=False)
+            return diff
+
+
+doc_cache = _DocCache()
+compact_lock = threading.Lock()  # sync_compact / init 직렬화
+
+
+# ---------------- Local write buffer (delta groups) ----------------
+# 로컬 변경(diff)은 캐시 문서에 바로 반영하고, DB에는 LOCAL_FLUSH_DELAY 동안 모아 merge 후 1건으로 기록
+doc_lock = threading.Lock()  # _pending_local_diffs / _local_flush_timer 보호
+_pending_local_diffs: List[bytes] = []
+_local_flush_timer: Optional[threading.Timer] = None
+
+
+def _schedule_local_flush() -> None:
+    """flush timer가 없으면 예약 (doc_lock을 잡은 상태에서 호출)."""
+    global _local_flush_timer
+    if _local_flush_timer is None:
+        _local_flush_timer = threading.Timer(LOCAL_FLUSH_DELAY, flush_local)
+        _local_flush_timer.daemon = True
+        _local_flush_timer.start()
+
+
+def buffer_local_diff(diff: bytes) -> None:
+    with doc_lock:
+        _pending_local_diffs.append(diff)
+        _schedule_local_flush()
+
+
+def flush_local() -> Optional[int]:
+    """버퍼된 로컬 diff들을 하나로 합쳐 DB에 기록 (sync/compact 전에 호출해 durable 보장)."""
+    global _local_flush_timer
+    # doc_cache.lock: flush 도중 init/compaction이 끼어들지 않도록
+    with doc_cache.lock:
+        with doc_lock:
+            if _local_flush_timer is not None:
+                _local_flush_timer.cancel()
+                _local_flush_timer = None
+            diffs = _pending_local_diffs[:]
+            _pending_local_diffs.clear()
+        if not diffs:
+            return None
+        try:
+            return db_insert_update(_merge_updates(diffs), origin="local")
+        except Exception:
+            with doc_lock:
+                _pending_local_diffs[:0] = diffs  # 다음 flush에서 재시도
+                # 다음 /add-count 등을 기다리지 않도록 timer를 다시 예약
+                _schedule_local_flush()
+            raise
+
+
+def discard_local() -> None:
+    """/init 시 아직 기록 안 된 로컬 diff 폐기."""
+    global _local_flush_timer
+    with doc_lock:
+        if _local_flush_timer is not None:
+            _local_flush_timer.cancel()
+            _local_flush_timer = None
+        _pending_local_diffs.clear()
 
 
 # ---------------- Core logic (endpoint-agnostic) -------------------
@@ -135,56 +513,105 @@ class UpdatePayload(BaseModel):
     update: str  # base64 (opaque Y/pycrdt update)
 
 
-def apply_incoming_update_b64(b64: str, origin: str = "remote") -> int:
-    """Decode base64 update and append to local updates table."""
+class UpdateBatchPayload(BaseModel):
+    updates: List[str]  # base64 updates, applied in order
+
+
+def validate_updates(updates: List[bytes]) -> None:
+    """commit 전에 update가 decode 가능한지 확인 (깨진 update는 400)."""
+    for update_bytes in updates:
+        try:
+            merge_updates(update_bytes, EMPTY_UPDATE)
+        except BaseException:
+            # 깨진 update는 apply_update에서 PanicException(BaseException)이 되므로 미리 거름
+            raise HTTPException(status_code=400, detail="invalid update")
+
+
+async def append_updates_if_changed(
+    rows: List[Tuple[bytes, str]],
+) -> List[Optional[int]]:
+    """
+    (검증된) update 중 문서를 실제로 바꾸는 것만 DB에 기록; 나머지는 seq 대신 None.
+    no-op row가 쌓이면 매번 touch()로 파생 캐시가 비워지고 컴팩션 기준도 부풀려짐.
+    """
+    changed = await asyncio.to_thread(doc_cache.apply_if_changed, [u for u, _o in rows])
+    todo = [row for row, c in zip(rows, changed) if c]
+    if not todo:
+        return [None] * len(rows)
     try:
-        update_bytes = base64.b64decode(b64)
-    except Exception:
-        raise HTTPException(status_code=400, detail="invalid base64 update")
+        # coalescer commit을 기다리는 동안 워커 스레드를 점유하지 않음
+        seqs = iter(await asyncio.wrap_future(enqueue_updates(todo)))
+    except BaseException:
+        # 캐시에만 반영되고 기록되지 않은 update 폐기 -> DB 기준으로 다시 재생
+        await asyncio.to_thread(doc_cache.reset)
+        raise
+    return [next(seqs) if c else None for c in changed]
+
+
+async def apply_incoming_updates_b64(
+    b64_list: List[str], origin: str = "remote"
+) -> List[Optional[int]]:
+    """Decode base64 updates and append them to local updates table in one commit."""
+    rows = []
+    for b64 in b64_list:
+        try:
+            update_bytes = base64.b64decode(b64)
+        except Exception:
+            raise HTTPException(status_code=400, detail="invalid base64 update")
+        if not update_bytes:
+            raise HTTPException(status_code=400, detail="empty update")
+        rows.append((update_bytes, origin))
+    if not rows:
+        return []
+    await asyncio.to_thread(validate_updates, [u for u, _o in rows])
+    return await append_updates_if_changed(rows)
+
+
+async def apply_incoming_update_b64(b64: str, origin: str = "remote") -> Optional[int]:
+    """Decode base64 update and append to local updates table (None if no-op)."""
+    return (await apply_incoming_updates_b64([b64], origin=origin))[0]
+
+
+async def apply_incoming_update_bytes(
+    update_bytes: bytes, origin: str = "remote"
+) -> Optional[int]:
+    """Append raw update bytes to local updates table (None if no-op)."""
     if not update_bytes:
         raise HTTPException(status_code=400, detail="empty update")
-    seq = db_insert_update(update_bytes, origin=origin)
-    return seq
+    await asyncio.to_thread(validate_updates, [update_bytes])
+    return (await append_updates_if_changed([(update_bytes, origin)]))[0]
 
 
 def sync_compact() -> dict:
     """
-    Read durable snapshot+updates from DB, replay to in-memory Doc,
-    upsert new durable snapshot, and delete applied updates.
+    Take the cached durable Doc (caught up with DB), upsert it as the new
+    durable snapshot, and delete the updates it already covers.
     """
-    # 1) load durable snapshot row
-    snap_bytes, last_seq = db_get_snapshot_row()
-
-    # 2) build a temporary Doc from durable snapshot to compute new state
-    tmp = YDoc(allow_multithreading=True)
-    if snap_bytes and len(snap_bytes) > 0:
-        tmp.apply_update(snap_bytes)
-
-    # 3) apply all pending updates after last_seq
-    pending = db_load_updates_since(last_seq)
-    if not pending:
-        return {
-            "applied": 0,
-            "deleted": 0,
-            "before_last_seq": last_seq,
-            "after_last_seq": last_seq,
-            "snapshot_bytes": len(snap_bytes or b""),
-        }
-
-    last_applied = last_seq
-    for seq, update_data in pending:
-        tmp.apply_update(update_data)
-        last_applied = seq
-
-    # 4) produce a fresh full-state snapshot (diff from empty)
-    new_snapshot = tmp.get_update()  # empty state -> full state
-
-    # 5) upsert durable snapshot and delete applied updates
-    db_upsert_snapshot(new_snapshot, last_seq=last_applied)
-    deleted = db_delete_updates_upto(last_applied)
+    with compact_lock:
+        # 1) load durable snapshot position
+        last_seq, snap_size = db_get_snapshot_meta()
+
+        # 2) durable Doc = snapshot + all pending updates (already replayed in cache)
+        with doc_cache.lock:
+            doc = rebuild_durable_doc()
+            last_applied = doc_cache.last_seq
+            if last_applied <= last_seq:
+                return {
+                    "applied": 0,
+                    "deleted": 0,
+                    "before_last_seq": last_seq,
+                    "after_last_seq": last_seq,
+                    "snapshot_bytes": snap_size,
+                }
+
+            # 3) produce a fresh full-state snapshot (diff from empty)
+            new_snapshot = doc.get_update()  # empty state -> full state
+
+        # 4) upsert durable snapshot and delete applied updates (single commit)
+        deleted = db_finalize_compaction(new_snapshot, last_seq=last_applied)
 
     return {
-        "applied": len(pending),
+        "applied": deleted,
         "deleted": deleted,
         "before_last_seq": last_seq,
         "after_last_seq": last_applied,
@@ -192,151 +619,235 @@ def sync_compact() -> dict:
     }
 
 
-def _crdt_to_json(value):
-    if isinstance(value, YMap):
-        keys = list(value.keys())
-        return {k: _crdt_to_json(value.get(k)) for k in keys}
-    if isinstance(value, YArr):
-        return [_crdt_to_json(v) for v in value]
-    return value
+def sync_compact_if_needed(
+    min_updates: int = COMPACT_MIN_UPDATES, min_bytes: int = COMPACT_MIN_BYTES
+) -> Optional[dict]:
+    """sync_compact() only once enough updates have piled up since the last snapshot."""
+    count, size = db_get_pending_stats()
+    if count < min_updates and size < min_bytes:
+        return None
+    return sync_compact()
 
 
 def rebuild_durable_doc() -> "YDoc":
     """
-    DB의 snapshot + updates를 순서대로 적용해 'durable' 문서를 임시로 재구성.
-    (이미 sync_compact에서 하던 방식 재사용)
+    메모리에 유지 중인 'durable' 문서를 DB와 맞춰서 반환.
+    (최초 1회만 snapshot + updates 전체 재생, 이후엔 last_seq 이후 변경분만 반영)
+    반환된 문서는 doc_cache.lock을 잡은 상태에서만 사용.
+    유일한 writer는 _add_count (로컬 변경을 캐시 문서에 직접 적용)이며, 그 외에는 읽기 전용.
+    문서를 변경한 호출자는 lock을 놓기 전에 반드시 doc_cache.touch()를 호출해야 함
+    (sv / diff LRU / 직렬화된 snapshot 등 파생 캐시 무효화).
     """
-    snapshot_bytes, last_seq = (
-        db_get_snapshot_row()
-    )  # (snapshot_bytes, last_seq) 튜플 가정
-    updates = db_load_updates_since(last_seq)  # [(seq, bytes), ...] 가정
-    doc = YDoc(allow_multithreading=True)
-    if snapshot_bytes:
-        doc.apply_update(snapshot_bytes)
-    for _seq, u in updates:
-        doc.apply_update(u)
-    return doc
+    return doc_cache.catch_up()
 
 
 # ---------------- HTTP endpoints (thin) ----------------------------
-app = FastAPI(title="CRDT sample (update + compact) with durable snapshots")
+@asynccontextmanager
+async def lifespan(app_: FastAPI):
+    async with _open_peer() as peer:
+        app_.state.peer = peer
+        yield
+        await asyncio.to_thread(flush_local)
+
+
+app = FastAPI(
+    title="CRDT sample (update + compact) with durable snapshots", lifespan=lifespan
+)
+
+
+# sqlite / pycrdt 호출은 blocking이므로 endpoint는 async로 두고 asyncio.to_thread로 넘김
+def _init_doc() -> int:
+    with compact_lock, doc_cache.lock:
+        discard_local()
+        db_init()
+        ydoc = YDoc(allow_multithreading=True)
+        ydoc["root"] = YMap({"count": 1, "message": "hello"})
+        ydoc["items"] = YArr([])
+        init_snapshot = ydoc.get_update()
+        ydoc.apply_update(init_snapshot)
+        max_seq = db_get_max_seq()
+        db_upsert_snapshot(init_snapshot, last_seq=max_seq)
+        doc_cache.reset(ydoc, last_seq=max_seq)
+    return max_seq
 
 
 @app.get("/init")
-def init_doc():
-    db_init()
-    ydoc = YDoc(allow_multithreading=True)
-    ydoc["root"] = YMap({"count": 1, "message": "hello"})
-    ydoc["items"] = YArr([])
-    init_snapshot = ydoc.get_update()
-    ydoc.apply_update(init_snapshot)
-    max_seq = db_get_max_seq()
-    db_upsert_snapshot(init_snapshot, last_seq=max_seq)
+async def init_doc():
+    max_seq = await asyncio.to_thread(_init_doc)
     return {"ok": True, "seq": max_seq, "doc_id": DOC_ID}
 
 
+# /get-snapshot 응답 캐시: doc_cache.version이 바뀌기 전까지 직렬화된 body를 재사용
+_snapshot_json_cache = {"version": -1, "body": b"", "etag": ""}
+
+
+def _render_snapshot() -> Tuple[bytes, str]:
+    """직렬화된 /get-snapshot body와 ETag (doc_cache.version 기준 캐시)."""
+    # durable 문서 (DB snapshot + 아직 컴팩션 전 updates)
+    with doc_cache.lock:
+        tmp = rebuild_durable_doc()
+        if _snapshot_json_cache["version"] != doc_cache.version:
+            if list(tmp.keys()):
+                db_json = {
+                    # to_py(): pycrdt(Rust)에서 재귀 변환
+                    "root": tmp.get("root", type=YMap).to_py(),
+                    "items": tmp.get("items", type=YArr).to_py(),
+                }
+            else:
+                db_json = None  # 아직 스냅샷 없음
+            body = json.dumps(
+                {"ok": True, "snapshot": db_json},
+                ensure_ascii=False,
+                separators=(",", ":"),
+            ).encode("utf-8")
+            _snapshot_json_cache["version"] = doc_cache.version
+            _snapshot_json_cache["body"] = body
+            # 내용 기반 ETag: 재시작/init 이후에도 다른 내용이 같은 태그를 갖지 않음
+            _snapshot_json_cache["etag"] = (
+                '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+            )
+        return _snapshot_json_cache["body"], _snapshot_json_cache["etag"]
+
+
 @app.get("/get-snapshot")
-def get_snapshot():
-    # durable snapshot (DB)
-    snap_bytes, _last_seq = db_get_snapshot_row()
-    if snap_bytes and len(snap_bytes) > 0:
-        tmp = YDoc(allow_multithreading=True)
-        tmp.apply_update(snap_bytes)
-        db_json = {
-            "root": _crdt_to_json(tmp.get("root", type=YMap)),
-            "items": _crdt_to_json(tmp.get("items", type=YArr)),
-        }
-    else:
-        db_json = None  # 아직 스냅샷 없음
-
-    return {"ok": True, "snapshot": db_json}
+async def get_snapshot(if_none_match: Optional[str] = Header(None)):
+    body, etag = await asyncio.to_thread(_render_snapshot)
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 
-@app.get("/add-count")
-def add_count():
-    tmp = YDoc(allow_multithreading=True)
-    snap_bytes, _last_seq = db_get_snapshot_row()
-    if snap_bytes and len(snap_bytes) > 0:
-        tmp.apply_update(snap_bytes)  # 임시 Doc 복원
-    root = tmp.get("root", type=YMap)
-
-    cur = root.get("count", 0)
-    sv_before = tmp.get_state()  # 이전 상태 추출
-    root["count"] = int(cur) + 1  # 값 추가(상태 변경)
-    diff = tmp.get_update(sv_before)  # 변경 증분만 추출
-    db_insert_update(diff, origin="local")
+def _add_count() -> None:
+    # 임시 Doc 복원 없이 캐시된 durable 문서를 직접 변경
+    with doc_cache.lock:
+        ydoc = rebuild_durable_doc()
+        root = ydoc.get("root", type=YMap)
+
+        cur = root.get("count", 0)
+        # 변경 증분은 transaction commit 이벤트에서 바로 받음
+        # (get_state() + get_update(sv)로 문서 전체 state vector를 인코딩/비교하지 않음)
+        deltas: List[bytes] = []
+        sub = ydoc.observe(lambda event: deltas.append(event.update))
+        try:
+            root["count"] = int(cur) + 1  # 값 추가(상태 변경)
+        finally:
+            ydoc.unobserve(sub)
+        diff = deltas[0]
+        doc_cache.touch()
+        buffer_local_diff(diff)  # DB 기록은 flush_local()에서 모아서
+
 
+@app.get("/add-count")
+async def add_count():
+    await asyncio.to_thread(_add_count)
     return {"ok": True}
 
 
 @app.get("/sv")
-def http_sv():
-    # 현재 내 state vector 반환
-    ydoc = rebuild_durable_doc()
-    sv = ydoc.get_state()
+async def http_sv():
+    # 현재 내 state vector 반환 (캐시돼 있으면 스레드 전환 없이)
+    sv = doc_cache.sv or await asyncio.to_thread(doc_cache.state_vector)
     return {"sv": base64.b64encode(sv).decode("ascii")}
 
 
+@app.get("/sv-bin")
+async def http_sv_bin():
+    sv = doc_cache.sv or await asyncio.to_thread(doc_cache.state_vector)
+    return Response(content=sv, media_type=OCTET_STREAM)
+
+
 @app.post("/diff")
-def http_diff(payload=Body(...)):
+async def http_diff(payload=Body(...)):
     #  입력 sv 기준 '상대가 모르는 diff' 반환 (없으면 None)
     b64 = payload.get("sv")
     if not isinstance(b64, str):
         return {"update": None}
     sv = base64.b64decode(b64)
-    ydoc = rebuild_durable_doc()
-    diff = ydoc.get_update(sv)
+    diff = await asyncio.to_thread(doc_cache.diff_since, sv)
     if not diff:
         return {"update": None}
     return {"update": base64.b64encode(diff).decode("ascii")}
 
 
+@app.post("/diff-bin")
+async def http_diff_bin(sv: bytes = Body(..., media_type=OCTET_STREAM)):
+    # /diff와 같지만 raw bytes로 주고받음 (diff 없으면 빈 body; diff_since 참고)
+    diff = await asyncio.to_thread(doc_cache.diff_since, sv)
+    return Response(content=diff, media_type=OCTET_STREAM)
+
+
 @app.get("/do-sync")
-def do_sync():
-    # A) 로컬 컴팩션 (지금 하던 그대로)
-    sync_compact()
+async def do_sync(request: Request):
+    peer: httpx.AsyncClient = request.app.state.peer
+    # 버퍼된 로컬 변경을 먼저 DB에 기록
+    await asyncio.to_thread(flush_local)
+
+    # A) 로컬 컴팩션 (update가 충분히 쌓였을 때만)
+    await asyncio.to_thread(sync_compact_if_needed)
 
     # durable 문서 준비
-    ydoc = rebuild_durable_doc()
-    sv_self = ydoc.get_state()
+    sv_self = doc_cache.sv or await asyncio.to_thread(doc_cache.state_vector)
 
-    # B) Pull: 내가 모르는 diff를 받기
-    r = requests.post(
-        f"{PEER_BASE}/diff", json={"sv": base64.b64encode(sv_self).decode("ascii")}
+    # B) Pull(내가 모르는 diff 받기) + C) 상대 sv 조회: 서로 의존성이 없으므로 동시에
+    # peer 간에는 base64 없이 raw bytes 엔드포인트(*-bin) 사용
+    r, r2 = await asyncio.gather(
+        peer.post("/diff-bin", content=sv_self, headers={"content-type": OCTET_STREAM}),
+        peer.get("/sv-bin"),
     )
     r.raise_for_status()
-    diff_b64 = (r.json() or {}).get("update")
-    if diff_b64:
-        diff = base64.b64decode(diff_b64)
-        # DB에 append 후 재컴팩션
-        db_insert_update(diff, origin="pull")
-        sync_compact()
-
-        # durable 재구성 (갱신된 스냅샷 기준으로 다시)
-        ydoc = rebuild_durable_doc()
+    r2.raise_for_status()
+    diff = r.content
+    # 빈 body(Python peer) / EMPTY_UPDATE(Node peer)는 바로 건너뜀. 그 외에도 delete set만
+    # 다시 담긴 no-op diff일 수 있으므로 문서를 실제로 바꿀 때만 기록
+    if diff and diff != EMPTY_UPDATE:
+        try:
+            await asyncio.to_thread(validate_updates, [diff])
+        except HTTPException:
+            raise HTTPException(status_code=502, detail="invalid update from peer")
+        (seq,) = await append_updates_if_changed([(diff, "pull")])
+        if seq is not None:
+            # DB에 append 후 재컴팩션 (필요할 때만)
+            await asyncio.to_thread(sync_compact_if_needed)
 
     # C) Push: 상대가 모르는 diff를 계산해 밀어넣기
-    r2 = requests.get(f"{PEER_BASE}/sv")
-    r2.raise_for_status()
-    sv_peer = base64.b64decode((r2.json() or {}).get("sv", ""))
-    diff_to_peer = ydoc.get_update(sv_peer)
+    sv_peer = r2.content
+    diff_to_peer = await asyncio.to_thread(doc_cache.diff_since, sv_peer)
     if diff_to_peer:
-        requests.post(
-            f"{PEER_BASE}/update",
-            json={"update": base64.b64encode(diff_to_peer).decode("ascii")},
-        ).raise_for_status()
-        requests.post(f"{PEER_BASE}/compact").raise_for_status()  # D) 원격 컴팩션
+        r3 = await peer.post(
+            "/update-bin",
+            content=diff_to_peer,
+            headers={"content-type": OCTET_STREAM},
+        )
+        r3.raise_for_status()
+        # D) 원격 컴팩션 (push한 update가 반영된 뒤에 실행돼야 하므로 순차)
+        # delete set 때문에 diff_to_peer는 거의 항상 비어 있지 않으므로, 상대 문서가 실제로
+        # 바뀐 경우에만 실행 ("changed"가 없는 peer(Node)는 기존처럼 항상 실행)
+        if r3.json().get("changed", True):
+            (await peer.post("/compact")).raise_for_status()
 
     return {"ok": True}
 
 
 @app.post("/update")
-def http_update(payload: UpdatePayload):
-    seq = apply_incoming_update_b64(payload.update, origin="remote")
-    return {"ok": True, "seq": seq}
+async def http_update(payload: UpdatePayload):
+    seq = await apply_incoming_update_b64(payload.update, origin="remote")
+    return {"ok": True, "seq": seq, "changed": seq is not None}
+
+
+@app.post("/update-bin")
+async def http_update_bin(update: bytes = Body(b"", media_type=OCTET_STREAM)):
+    seq = await apply_incoming_update_bytes(update, origin="remote")
+    return {"ok": True, "seq": seq, "changed": seq is not None}
+
+
+@app.post("/update-batch")
+async def http_update_batch(payload: UpdateBatchPayload):
+    seqs = await apply_incoming_updates_b64(payload.updates, origin="remote")
+    return {"ok": True, "seqs": seqs}
 
 
 @app.post("/compact")
-def http_compact():
-    result = sync_compact()
+async def http_compact():
+    await asyncio.to_thread(flush_local)
+    result = await asyncio.to_thread(sync_compact)
     return {"ok": True, "result": result}
@@ -32,6 +32,8 @@ async function initDDL() {
       updated_at INTEGER NOT NULL
     );
   `);
+
+    await db.execute(`CREATE INDEX IF NOT EXISTS ix_updates_doc_seq ON updates (doc_id, seq)`);
 }
 
 // ---------------- DB helpers ------------------------------------
@@ -220,6 +222,8 @@ async function rebuildDurableDoc(): Promise<Y.Doc> {
 // ---------------- HTTP (thin endpoints) --------------------------
 const app: any = express();
 app.use(bodyParser.json());
+// peer 간 raw bytes 전송용 (*-bin 엔드포인트)
+const rawBody = bodyParser.raw({ type: 'application/octet-stream', limit: '50mb' });
 
 app.get('/init', async (_req: any, res: any) => {
     console.log('GET /init');
@@ -280,6 +284,13 @@ app.get('/sv', async (_req: any, res: any) => {
     res.json({ sv: Buffer.from(sv).toString('base64') });
 });
 
+app.get('/sv-bin', async (_req: any, res: any) => {
+    // /sv와 같지만 raw bytes로 반환
+    console.log('GET /sv-bin');
+    const ydoc = await rebuildDurableDoc();
+    res.type('application/octet-stream').send(Buffer.from(Y.encodeStateVector(ydoc)));
+});
+
 app.post('/diff', async (req: any, res: any) => {
     // /diff: 입력 sv 기준 '상대가 모르는 diff' 반환 (없으면 null)
     console.log('POST /diff');
@@ -291,6 +302,18 @@ app.post('/diff', async (req: any, res: any) => {
     res.json({ update: Buffer.from(diff).toString('base64') });
 });
 
+app.post('/diff-bin', rawBody, async (req: any, res: any) => {
+    // /diff와 같지만 raw bytes로 주고받음
+    console.log('POST /diff-bin');
+    if (!Buffer.isBuffer(req.body) || req.body.byteLength === 0) {
+        return res.status(400).json({ error: 'missing sv (octet-stream)' });
+    }
+    const sv = _buf2U8Arr(req.body);
+    const ydoc = await rebuildDurableDoc();
+    const diff = Y.encodeStateAsUpdate(ydoc, sv);
+    res.type('application/octet-stream').send(Buffer.from(diff));
+});
+
 app.get('/do-sync', async (_req: any, res: any) => {
     console.log('GET /do-sync');
     // A) 로컬 컴팩션 (지금 하던 그대로)
@@ -352,6 +375,20 @@ app.post('/update', async (req: any, res: any) => {
     }
 });
 
+app.post('/update-bin', rawBody, async (req: any, res: any) => {
+    console.log('POST /update-bin');
+    try {
+        if (!Buffer.isBuffer(req.body) || req.body.byteLength === 0) {
+            return res.status(400).json({ error: 'missing update (octet-stream)' });
+        }
+        const seq = await dbInsertUpdate(_buf2U8Arr(req.body), 'remote');
+        res.json({ ok: true, seq });
+    } catch (e: any) {
+        console.error('update error:', e);
+        res.status(e.status || 500).json({ error: e.message || 'internal_error' });
+    }
+});
+
 app.post('/compact', async (_req: any, res: any) => {
     console.log('POST /compact');
     try {
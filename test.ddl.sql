@@ -11,4 +11,6 @@ CREATE TABLE IF NOT EXISTS snapshots (
     snapshot_data   BLOB NOT NULL,   -- full-state encoded as a single Y update
     last_seq   INTEGER NOT NULL,
     updated_at INTEGER NOT NULL
-);
\ No newline at end of file
+);
+
+CREATE INDEX IF NOT EXISTS ix_updates_doc_seq ON updates (doc_id, seq);
\ No newline at end of file